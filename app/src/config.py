@@ -10,12 +10,38 @@ class HTTPConfigs:
          retries: Number of retry attempts for failed HTTP requests.
          delay: Initial delay (in seconds) before retrying a failed request.
          backoff: Multiplier applied to delay for each subsequent retry.
+         max_retry_after: Maximum delay (in seconds) accepted from the `Retry-After` header.
+         keepalive_timeout: Time (in seconds) to keep idle connections open for reuse.
+         dns_cache_ttl: Time (in seconds) to cache resolved DNS records.
+         timeout: Total timeout (in seconds) for a single HTTP request.
 
      """
     max_concurrent_requests: int = 5
     retries: int = 5
     delay: int = 3
     backoff: int = 3
+    max_retry_after: int = 120
+    keepalive_timeout: int = 75
+    dns_cache_ttl: int = 300
+    timeout: int = 60
 
 
 http_configs = HTTPConfigs()
+
+
+@dataclass(frozen=True)
+class ParquetConfigs:
+    """Dataclass to store Parquet writing parameters.
+
+     Attributes:
+         compression: Compression codec used for all columns.
+         compression_level: Compression level of the codec.
+         data_page_size: Target size (in bytes) of a data page within a column chunk.
+
+     """
+    compression: str = "zstd"
+    compression_level: int = 3
+    data_page_size: int = 1 << 20
+
+
+parquet_configs = ParquetConfigs()
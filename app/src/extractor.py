@@ -1,12 +1,16 @@
 import os
-import json
+import glob
+import math
 import hashlib
 import asyncio
 import logging
 import random
-from datetime import date
-from collections import defaultdict
+import uuid
+from email.utils import parsedate_to_datetime
+from datetime import date, datetime, timezone
+from typing import Mapping, Optional
 
+import orjson
 import pandas as pd
 import aiohttp
 import asyncpg
@@ -14,24 +18,28 @@ from aiohttp import ClientError, ClientResponseError
 from asyncpg.exceptions import PostgresError
 
 from config import http_configs
-from utils import get_date_path_directories
+from limiter import AdmissionController
+from utils import get_date_path_directories, link_file
 from exceptions import MaximumRetryException
 
 logger = logging.getLogger(__name__)
 
 
-def get_remote_json_hash(json_content: dict) -> str:
-    """Computes the SHA256 hash of the given JSON content.
+def get_remote_json_hash(raw_content: bytes) -> str:
+    """Computes the SHA256 hash of the given raw JSON content.
+
+    The raw response body is hashed as is, so there is no need to parse
+    and re-serialize the JSON content beforehand. The hash is only used as
+    a change token for the `metadata_tbl`, not as a security primitive.
 
     Args:
-        json_content: JSON content to hash.
+        raw_content: Raw JSON content (response body) to hash.
 
     Returns:
         The hexadecimal SHA256 hash.
 
     """
-    return hashlib.sha256(
-        json.dumps(json_content, sort_keys=True).encode("utf-8")).hexdigest()
+    return hashlib.sha256(raw_content, usedforsecurity=False).hexdigest()
 
 
 async def check_response(response: aiohttp.ClientResponse) -> None:
@@ -50,160 +58,379 @@ async def check_response(response: aiohttp.ClientResponse) -> None:
             history=response.history,
             status=response.status,
             message=f"HTTP Error: {response.status}",
+            headers=response.headers,
         )
 
 
+def get_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Parses the `Retry-After` header of the HTTP response.
+
+    Args:
+        headers: The HTTP response headers.
+
+    Returns:
+        The delay (in seconds) requested by the server, capped at `max_retry_after`,
+            or None if it is absent or malformed.
+
+    """
+    retry_after = headers.get("Retry-After") if headers else None
+    if retry_after is None:
+        return None
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        try:
+            retry_datetime = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if retry_datetime.tzinfo is None:
+            retry_datetime = retry_datetime.replace(tzinfo=timezone.utc)
+        delay = (retry_datetime - datetime.now(timezone.utc)).total_seconds()
+    # `float()` also accepts "inf" and "nan", which must not pause all the requests forever.
+    if not math.isfinite(delay):
+        return None
+    return min(max(delay, 0.0), http_configs.max_retry_after)
+
+
 async def get_http_response(
         session: aiohttp.ClientSession,
         url: str,
-) -> aiohttp.ClientResponse:
-    """Asynchronously makes GET request and returns the response.
+        limiter: AdmissionController
+) -> bytes:
+    """Asynchronously makes GET request and returns the response body.
+
+    The response is read and released within this function, so no connection
+    is left hanging between retries. On HTTP 429 the delay from the `Retry-After`
+    header (or an exponential backoff with jitter) is applied, the concurrency
+    slot is given back for the whole backoff and all new requests are paused
+    until it is over.
 
     Args:
         session: The HTTP session.
         url: The URL to request.
+        limiter: Admission controller limiting the number of concurrent requests.
 
     Returns:
-        The HTTP response.
+        The raw body of the HTTP response.
 
     """
     init_delay = http_configs.delay
     for attempt in range(http_configs.retries):
-        try:
-            response = await session.get(url)
-            await check_response(response)
-            return response
-        except ClientError as e:
-            if "HTTP Error: 429" in str(e):
-                jitter = random.uniform(0, init_delay)
-                extended_delay = init_delay + jitter
+        async with limiter:
+            try:
+                async with session.get(url) as response:
+                    await check_response(response)
+                    return await response.read()
+            except ClientError as e:
+                if not isinstance(e, ClientResponseError) or e.status != 429:
+                    logger.exception("Error fetching URL %s: %s", url, e)
+                    raise e
+                extended_delay = get_retry_after(e.headers)
+                if extended_delay is None:
+                    jitter = random.uniform(0, init_delay)
+                    extended_delay = init_delay + jitter
+                limiter.pause(extended_delay)
                 logger.warning(
                     "HTTP 429 received for URL %s. Retrying in %.2f seconds (attempt %d)...",
                     url, extended_delay, attempt)
-                await asyncio.sleep(extended_delay)
-                init_delay *= http_configs.backoff
-            else:
-                logger.exception("Error fetching URL %s: %s", url, e)
-                raise e
+        await asyncio.sleep(extended_delay)
+        init_delay *= http_configs.backoff
     raise MaximumRetryException(f"Max retries reached for URL: {url}")
 
 
-async def extract(
-        api_url_template: str,
+async def get_known_hashes(
+        conn: asyncpg.Connection,
         start_date_range: date,
         yesterday_date: date
 ) -> dict[date, str]:
+    """Asynchronously fetches the stored hashes for the whole date range in one query.
+
+    Args:
+        conn: The database connection to the `metadata_db`.
+        start_date_range: The start date of the required date range.
+        yesterday_date: The end date of the required date range.
+
+    Returns:
+        A dictionary mapping each already uploaded date to its hash.
+
+    """
+    records = await conn.fetch(
+        "SELECT file_date, hash FROM metadata_tbl WHERE file_date BETWEEN $1 AND $2",
+        start_date_range, yesterday_date)
+    return {record["file_date"]: record["hash"] for record in records}
+
+
+async def upload_hashes(conn: asyncpg.Connection, hashes: list[tuple[date, str]]) -> None:
+    """Asynchronously inserts or updates the hashes of the changed dates in one batch.
+
+    Rows whose stored hash already matches (e.g. written by a concurrent run)
+    are left untouched.
+
+    Args:
+        conn: The database connection to the `metadata_db`.
+        hashes: Pairs of the date and its new hash.
+
+    """
+    await conn.executemany(
+        "INSERT INTO metadata_tbl (file_date, hash) VALUES ($1, $2) "
+        "ON CONFLICT (file_date) DO UPDATE SET hash = EXCLUDED.hash "
+        "WHERE metadata_tbl.hash IS DISTINCT FROM EXCLUDED.hash",
+        hashes)
+
+
+async def extract(
+        api_url_template: str,
+        start_date_range: date,
+        yesterday_date: date,
+        queue: asyncio.Queue
+) -> None:
     """Asynchronously extracts JSON data for each date in the specified range.
 
     It extracts data from the API and saves the data locally if changed.
+    Each saved JSON file is put into the queue right away, so it can be transformed
+    while the other dates are still being fetched.
 
     Args:
         api_url_template: The API URL template with a placeholder for the date.
         start_date_range: The start date of the required date range.
         yesterday_date: The end date of the required date range
             (it is always implied yesterday's date).
-
-    Returns:
-        A dictionary mapping each date to the path of the downloaded JSON file.
+        queue: Queue to put (date, JSON file path) pairs of the saved files into.
 
     """
-    all_dates = pd.date_range(start=start_date_range, end=yesterday_date).date.tolist()
-    json_to_download = defaultdict(str)
-
-    # conn = await asyncpg.connect(...)
-    # rows = await conn.fetch("SELECT * FROM table;")
-    # await conn.close()
+    date_index = pd.date_range(start=start_date_range, end=yesterday_date)
+    all_dates = date_index.date.tolist()
+    all_urls = list(map(api_url_template.format, date_index.strftime("%d-%m-%Y")))
 
+    # The `metadata_db` is only queried twice per run (one read before and one batched
+    # write after fetching), so a single connection is enough and no pool is needed.
     try:
-        pool = await asyncpg.create_pool(
+        conn = await asyncpg.connect(
             database=os.getenv("METADATA_DB"),
             user=os.getenv("USER_METADATA_DB"),
             password=os.getenv("PASSWORD_METADATA_DB"),
             host=os.getenv("HOST_METADATA_DB"),
-            min_size=7,
-            max_size=14,
-            timeout=60
+            timeout=60,
+            command_timeout=30
         )
     except PostgresError as e:
         logger.exception("Failed to connect to `metadata_db`: %s", e)
         raise
 
-    semaphore = asyncio.Semaphore(http_configs.max_concurrent_requests)
+    try:
+        try:
+            known_hashes = await get_known_hashes(conn, start_date_range, yesterday_date)
+        except PostgresError as e:
+            logger.exception("Error reading metadata for dates from %s to %s: %s",
+                             start_date_range, yesterday_date, e)
+            raise
+
+        await asyncio.to_thread(remove_blob_part_files, os.getenv("RAW_DATA_DIR"))
+
+        limiter = AdmissionController(http_configs.max_concurrent_requests)
+
+        # All requests go to the same host, so one pool of keep-alive connections
+        # lets every date reuse an already established TCP + TLS session.
+        connector = aiohttp.TCPConnector(
+            limit=http_configs.max_concurrent_requests,
+            limit_per_host=http_configs.max_concurrent_requests,
+            keepalive_timeout=http_configs.keepalive_timeout,
+            ttl_dns_cache=http_configs.dns_cache_ttl,
+            enable_cleanup_closed=True
+        )
+        timeout = aiohttp.ClientTimeout(total=http_configs.timeout)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tasks = []
+            for particular_date, url in zip(all_dates, all_urls):
+                tasks.append(process_date(session, particular_date, url, limiter,
+                                          known_hashes, queue))
+
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            changed_hashes = []
+            for particular_date, result in zip(all_dates, results):
+                if isinstance(result, BaseException):
+                    logger.error("Skipping date %s due to unexpected error: %r",
+                                 particular_date, result, exc_info=result)
+                elif result is not None:
+                    changed_hashes.append(result)
+
+        if changed_hashes:
+            try:
+                await upload_hashes(conn, changed_hashes)
+            except PostgresError as e:
+                logger.exception("Error updating/uploading metadata: %s", e)
+            else:
+                for particular_date, _ in changed_hashes:
+                    if particular_date in known_hashes:
+                        logger.warning("Data for %s has been updated.", particular_date)
+                    else:
+                        logger.info("Metadata for date %s has been uploaded.", particular_date)
+    finally:
+        await conn.close()
+
+
+def get_blob_file_path(raw_data_dir: str, remote_hash: str) -> str:
+    """Constructs the content-addressed path of the raw JSON content with the given hash.
+
+    The blobs are kept under the `_blobs` directory, which is ignored by the readers
+    of the `year=/month=/day=` partitioned layout.
 
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for particular_date in all_dates:
-            formatted_date = particular_date.strftime("%d-%m-%Y")
-            url = api_url_template.format(formatted_date)
-            tasks.append(process_date(session, pool, particular_date, url, semaphore))
+    Args:
+        raw_data_dir: The root directory of the raw data.
+        remote_hash: The hash of the raw JSON content.
+
+    Returns:
+        The path in the `{raw_data_dir}/_blobs/{hash[:2]}/{hash}.json` format.
+
+    """
+    return os.path.join(raw_data_dir, "_blobs", remote_hash[:2], f"{remote_hash}.json")
 
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        for result in results:
-            if isinstance(result, dict):
-                json_to_download.update(result)
 
-    await pool.close()
-    return json_to_download
+def remove_blob_part_files(raw_data_dir: str) -> None:
+    """Synchronously removes the temporary blob `.part` files left by interrupted runs.
+
+    It must be called before any blob is written in the current run.
+
+    Args:
+        raw_data_dir: The root directory of the raw data.
+
+    """
+    for path_to_part_file in glob.glob(os.path.join(raw_data_dir, "_blobs", "*", "*.part")):
+        os.unlink(path_to_part_file)
+        logger.info("Removed leftover temporary file %s", path_to_part_file)
+
+
+def write_blob_file(path_to_blob_file: str, raw_data: bytes) -> None:
+    """Synchronously writes the raw JSON content to the content-addressed blob file.
+
+    The blob is published with a hard link, which never replaces an existing file,
+    so when several dates with the same content write it concurrently, the first one
+    wins and all of their JSON files end up linked to the same inode.
+
+    Args:
+        path_to_blob_file: The content-addressed file path to store the content in.
+        raw_data: Raw JSON content to save.
+
+    """
+    os.makedirs(os.path.dirname(path_to_blob_file), exist_ok=True)
+    # Another date with the same content may be written concurrently, hence a unique name.
+    path_to_part_file = f"{path_to_blob_file}.{uuid.uuid4().hex}.part"
+    try:
+        with open(path_to_part_file, "wb") as f_json_out:
+            f_json_out.write(raw_data)
+        try:
+            os.link(path_to_part_file, path_to_blob_file)
+        except FileExistsError:
+            # The same content has already been published by another date.
+            pass
+    finally:
+        if os.path.exists(path_to_part_file):
+            os.unlink(path_to_part_file)
+
+
+def save_json_file(
+        raw_data_dir: str,
+        path_to_json_file: str,
+        raw_data: bytes,
+        remote_hash: str
+) -> None:
+    """Synchronously saves the raw JSON content to the file, creating its directory if needed.
+
+    The response body is already JSON, so it is saved byte for byte. Identical contents
+    are stored only once in the content-addressed blob file, and the JSON file is made
+    a hard link to it. Both are published from temporary `.part` files, so a reader
+    never sees a partially written `file.json`. The blob of the previous content is removed
+    once no JSON file links to it anymore.
+
+    Args:
+        raw_data_dir: The root directory of the raw data.
+        path_to_json_file: The file path to the JSON file.
+        raw_data: Raw JSON content to save.
+        remote_hash: The hash of the raw JSON content.
+
+    """
+    path_to_blob_file = get_blob_file_path(raw_data_dir, remote_hash)
+
+    path_to_stale_blob_file = None
+    json_file_stat = None
+    if os.path.exists(path_to_json_file):
+        json_file_stat = os.stat(path_to_json_file)
+        with open(path_to_json_file, "rb") as f_json_in:
+            old_hash = get_remote_json_hash(f_json_in.read())
+        if old_hash != remote_hash:
+            path_to_stale_blob_file = get_blob_file_path(raw_data_dir, old_hash)
+
+    if not os.path.exists(path_to_blob_file):
+        write_blob_file(path_to_blob_file, raw_data)
+    try:
+        link_file(path_to_blob_file, path_to_json_file)
+    except FileNotFoundError:
+        # The blob may have just been removed as stale by another date, so it is written again.
+        write_blob_file(path_to_blob_file, raw_data)
+        link_file(path_to_blob_file, path_to_json_file)
+
+    if path_to_stale_blob_file is not None:
+        try:
+            stale_blob_file_stat = os.stat(path_to_stale_blob_file)
+        except FileNotFoundError:
+            return
+        # Only the blob the JSON file pointed to is removed, and only if nothing links to it.
+        if os.path.samestat(stale_blob_file_stat, json_file_stat) \
+                and stale_blob_file_stat.st_nlink == 1:
+            os.unlink(path_to_stale_blob_file)
 
 
 async def process_date(
         session: aiohttp.ClientSession,
-        pool: asyncpg.Pool,
         particular_date: date,
         url: str,
-        semaphore: asyncio.Semaphore
-) -> dict[date, str]:
+        limiter: AdmissionController,
+        known_hashes: dict[date, str],
+        queue: asyncio.Queue
+) -> Optional[tuple[date, str]]:
     """Asynchronously processes a single date.
 
     It fetches data from the API, checks metadata, and saves the JSON file if necessary.
+    The metadata itself is uploaded by the caller in one batch for all dates.
 
     Args:
         session: The HTTP session.
-        pool: The database connection pool to the `metadata_db`.
         particular_date: The date to extract.
         url: The API URL for the date.
-        semaphore: Semaphore limiting the number of concurrent requests.
+        limiter: Admission controller limiting the number of concurrent requests.
+        known_hashes: Hashes already stored in the `metadata_db`, keyed by date.
+        queue: Queue to put the (date, JSON file path) pair into once the file is saved.
 
     Returns:
-        A dictionary with the date and path to the JSON file if new data was downloaded,
-            otherwise an empty dictionary.
+        A tuple of the date and its hash if new data was downloaded, otherwise None.
 
     """
     try:
-        async with semaphore:
-            response = await get_http_response(session, url)
-        json_data = await response.json()
-    except ClientError as e:
+        raw_data = await get_http_response(session, url, limiter)
+    except (ClientError, asyncio.TimeoutError) as e:
         logger.exception("Skipping date %s due to error in fetching data: %s",
                          particular_date, e)
-        return {}
+        return None
 
-    remote_hash = get_remote_json_hash(json_data)
+    remote_hash = get_remote_json_hash(raw_data)
 
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            try:
-                record = await conn.fetchrow("SELECT hash FROM metadata_tbl WHERE file_date = $1",
-                                             particular_date)
-            except PostgresError as e:
-                logger.exception("Error reading metadata for date %s: %s",
-                                 particular_date, e)
-                return {}
-            if record and record.get("hash") == remote_hash:
-                logger.info("Data for date %s is already uploaded.", particular_date)
-                return {}
-            try:
-                if record:
-                    await conn.execute("UPDATE metadata_tbl SET hash = $1 WHERE file_date = $2",
-                                       remote_hash, particular_date)
-                    logger.warning("Data for %s has been updated.", particular_date)
-                else:
-                    await conn.execute("INSERT INTO metadata_tbl (file_date, hash) VALUES ($1, $2)",
-                                       particular_date, remote_hash)
-                    logger.info("Metadata for date %s has been uploaded.", particular_date)
-            except PostgresError as e:
-                logger.exception("Error updating/uploading metadata for date %s: %s",
-                                 particular_date, e)
+    if known_hashes.get(particular_date) == remote_hash:
+        logger.info("Data for date %s is already uploaded.", particular_date)
+        return None
+
+    # Only changed data is parsed: a non-JSON body (e.g. an HTML error page
+    # returned with status 200) must not be saved or recorded as uploaded.
+    try:
+        json_data = orjson.loads(raw_data)
+    except orjson.JSONDecodeError as e:
+        logger.exception("Skipping date %s due to invalid JSON in response: %s",
+                         particular_date, e)
+        return None
+    if not isinstance(json_data, dict):
+        logger.error("Skipping date %s due to unexpected JSON structure: expected an object, got %s",
+                     particular_date, type(json_data).__name__)
+        return None
 
     raw_data_dir = os.getenv("RAW_DATA_DIR")
     particular_date_dir_raw_path = get_date_path_directories(
@@ -212,21 +439,17 @@ async def process_date(
         month=particular_date.month,
         day=particular_date.day
     )
-    os.makedirs(particular_date_dir_raw_path, exist_ok=True)
     path_to_json_file = os.path.join(particular_date_dir_raw_path, "file.json")
 
     try:
-        with open(path_to_json_file, "w", encoding="utf-8") as f_json_out:
-            json.dump(json_data, f_json_out)  # type: ignore
+        await asyncio.to_thread(save_json_file, raw_data_dir, path_to_json_file, raw_data,
+                                remote_hash)
         logger.info("Saved JSON for date %s to %s",
                     particular_date, path_to_json_file)
-    except TypeError as e:
-        logger.exception("JSON serialization error for date %s: %s",
-                         particular_date, e)
-        return {}
     except Exception as e:
         logger.exception("Error saving JSON file for date %s: %s",
                          particular_date, e)
-        return {}
+        return None
 
-    return {particular_date: path_to_json_file}
+    await queue.put((particular_date, path_to_json_file))
+    return particular_date, remote_hash
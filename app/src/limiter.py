@@ -0,0 +1,63 @@
+import asyncio
+
+
+class AdmissionController:
+    """Limits the number of concurrent HTTP requests and pauses them all on rate limiting.
+
+    Unlike a plain semaphore, a slot can be given back while a request is backing off,
+    and a rate limit hit by one request holds back every new request until it expires.
+
+    Attributes:
+        capacity: Maximum number of requests admitted at the same time.
+
+    """
+
+    def __init__(self, capacity: int) -> None:
+        """Initialize the AdmissionController.
+
+        Args:
+            capacity: Maximum number of requests admitted at the same time.
+
+        """
+        self.capacity = capacity
+        self._lock = asyncio.Lock()
+        self._cond = asyncio.Condition(self._lock)
+        self._active = 0
+        self._paused_until = 0.0
+
+    async def acquire(self) -> None:
+        """Asynchronously waits until the pause is over and a slot is free, then takes the slot."""
+        loop = asyncio.get_running_loop()
+        while True:
+            pause = self._paused_until - loop.time()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            async with self._cond:
+                await self._cond.wait_for(lambda: self._active < self.capacity)
+                # The pause could have been extended while waiting for a free slot.
+                if self._paused_until <= loop.time():
+                    self._active += 1
+                    return
+
+    async def release(self) -> None:
+        """Asynchronously gives the slot back and wakes up one waiting request."""
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify(1)
+
+    def pause(self, delay: float) -> None:
+        """Holds back all new requests for the given time.
+
+        Args:
+            delay: Time (in seconds) to pause new requests for.
+
+        """
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + delay)
+
+    async def __aenter__(self) -> "AdmissionController":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await self.release()
@@ -4,6 +4,8 @@ import asyncio
 import logging
 from datetime import datetime, timedelta
 
+import uvloop
+
 from extractor import extract
 from transformer import transform_json_to_parquet
 
@@ -40,12 +42,19 @@ async def main() -> None:
 
     api_url_template = "https://api.coingecko.com/api/v3/coins/bitcoin/history?date={}"
 
-    json_to_download = await extract(api_url_template, start_date_range, yesterday_date)
-
-    await transform_json_to_parquet(json_to_download)
+    # Files are transformed as soon as they are downloaded instead of after the whole extraction.
+    queue = asyncio.Queue()
+    transform_task = asyncio.create_task(transform_json_to_parquet(queue))
+    try:
+        await extract(api_url_template, start_date_range, yesterday_date, queue)
+    finally:
+        await queue.put(None)
+        await transform_task
 
 
 if __name__ == "__main__":
+    # The libuv-based event loop speeds up the socket-bound aiohttp and asyncpg code.
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(main())
     except Exception as e:
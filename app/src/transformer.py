@@ -1,78 +1,202 @@
 import os
 import asyncio
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from datetime import date
-from json.decoder import JSONDecodeError
+from typing import Optional
 
-import pandas as pd
+import orjson
 import pyarrow as pa
 import pyarrow.parquet as pq
 
-from utils import get_date_path_directories
+from config import parquet_configs
+from utils import get_date_path_directories, get_part_file_path, link_file
 
 logger = logging.getLogger(__name__)
 
+# Top-level keys of the API response that hold nested JSON objects. They are always
+# stored as string columns, even if the value is null for some date, so that the schema
+# stays the same across all the date partitions.
+JSON_STRING_COLUMNS = frozenset({
+    "localization",
+    "image",
+    "market_data",
+    "community_data",
+    "developer_data",
+    "public_interest_stats",
+})
 
-async def transform_json_to_parquet(dct_jsons: dict[date, str]) -> None:
-    """Asynchronously transforms downloaded JSON files into Parquet format and saves them.
+
+async def transform_json_to_parquet(queue: asyncio.Queue) -> None:
+    """Asynchronously transforms downloaded JSON files into Parquet format as soon as they land.
 
     Args:
-        dct_jsons: Dictionary mapping dates to JSON file paths.
+        queue: Queue of (date, JSON file path) pairs filled by the extractor.
+            A None item signals that the extraction is over.
 
     """
 
     # asyncio.create_task(async_task()): for `async` code, in event loop
     # asyncio.to_thread(sync_task()): for `sync` code and blocking code, in a separate thread
+    # loop.run_in_executor(ProcessPoolExecutor(), cpu_task): for CPU-bound code, in a separate
+    #     process (JSON parsing and Parquet conversion hold the GIL for most of their work)
+
+    max_workers = os.cpu_count() or 1
+    # JSON files of dates with identical content are hard links to the same blob,
+    # so each (device, inode) pair is converted only once.
+    conversions = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        workers = [asyncio.create_task(transform_worker(queue, executor, conversions))
+                   for _ in range(max_workers)]
+        await asyncio.gather(*workers)
+
+
+async def transform_worker(
+        queue: asyncio.Queue,
+        executor: ProcessPoolExecutor,
+        conversions: dict[tuple[int, int], asyncio.Future]
+) -> None:
+    """Asynchronously takes JSON files from the queue and transforms them until the end signal.
+
+    If the same JSON file (by inode) has already been converted for another date,
+    its Parquet file is reused instead of converting the JSON again.
+
+    Args:
+        queue: Queue of (date, JSON file path) pairs filled by the extractor.
+        executor: The process pool to run the transformation in.
+        conversions: Conversions shared between the workers, keyed by the (device, inode)
+            of the JSON file, resolving to the path of the Parquet file or None on failure.
+
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        if item is None:
+            # Put the end signal back, so that the other workers stop as well.
+            queue.put_nowait(None)
+            return
+        file_date, path_to_json_file = item
+        try:
+            json_file_stat = os.stat(path_to_json_file)
+            json_file_key = (json_file_stat.st_dev, json_file_stat.st_ino)
+            if json_file_key in conversions:
+                path_to_source_parquet_file = await conversions[json_file_key]
+                if path_to_source_parquet_file is None:
+                    logger.warning("Skipping date %s: conversion of identical JSON file %s failed",
+                                   file_date, path_to_json_file)
+                    continue
+                path_to_parquet_file = get_parquet_file_path(file_date)
+                await asyncio.to_thread(link_file, path_to_source_parquet_file,
+                                        path_to_parquet_file)
+                logger.info("Reused Parquet file %s for date %s with identical JSON",
+                            path_to_source_parquet_file, file_date)
+                continue
+            conversions[json_file_key] = loop.run_in_executor(
+                executor, process_file, file_date, path_to_json_file)
+            await conversions[json_file_key]
+        except Exception as e:
+            logger.exception("Error transforming JSON file %s: %s", path_to_json_file, e)
+
+
+def build_table(json_data: dict) -> pa.Table:
+    """Builds a single-row Arrow table from the JSON object.
+
+    Each top-level key becomes a column. Nested objects and arrays (e.g. `market_data`)
+    are stored as JSON strings (nulls stay nulls), because pyarrow cannot infer a stable
+    type for them and their shape varies from date to date.
 
-    tasks = []
-    for file_date, path_to_json_file in dct_jsons.items():
-        tasks.append(asyncio.to_thread(process_file, file_date, path_to_json_file))
-    await asyncio.gather(*tasks)
+    Args:
+        json_data: The parsed JSON object.
+
+    Returns:
+        The Arrow table with one row.
+
+    """
+    columns = {}
+    for key, value in json_data.items():
+        if key in JSON_STRING_COLUMNS or isinstance(value, (dict, list)):
+            json_string = None if value is None else orjson.dumps(value).decode()
+            columns[key] = pa.array([json_string], type=pa.string())
+        else:
+            columns[key] = pa.array([value])
+    return pa.table(columns)
+
+
+def get_parquet_file_path(file_date: date) -> str:
+    """Constructs the path of the Parquet file for the given date.
+
+    Args:
+        file_date: The date associated with the file.
 
+    Returns:
+        The file path to the Parquet file.
 
-def process_file(file_date: date, path_to_json_file: str) -> None:
+    """
+    processed_data_dir = os.getenv("PROCESSED_DATA_DIR")
+    particular_date_dir_processed_path = get_date_path_directories(
+        base_path=processed_data_dir,
+        year=file_date.year,
+        month=file_date.month,
+        day=file_date.day)
+    return os.path.join(particular_date_dir_processed_path, "file.parquet")
+
+
+def process_file(file_date: date, path_to_json_file: str) -> Optional[str]:
     """Synchronously transforms a single JSON file into Parquet format and saves them.
 
     Args:
         file_date: The date associated with the file.
         path_to_json_file: The file path to the JSON file.
 
+    Returns:
+        The file path to the saved Parquet file, or None if the transformation failed.
+
     """
     try:
-        df = pd.read_json(path_to_json_file)
-    except JSONDecodeError as e:
+        json_data = orjson.loads(Path(path_to_json_file).read_bytes())
+    except orjson.JSONDecodeError as e:
         logger.exception("JSON serialization error with %s: %s",
                          path_to_json_file, e)
-        return
+        return None
     except Exception as e:
         logger.exception("Error reading JSON file %s: %s",
                           path_to_json_file, e)
-        return
+        return None
 
-    # This clause is necessary to avoid trouble during JSON-Parquet converting.
-    # The `market_data` column often contains nested JSON objects or complex types
-    # that pyarrow cannot handle directly. Converting it to a string ensures the data
-    # is flattened and avoids conversion errors.
-    # P.S. I know it's terrible to hardcode like this, but please allow me to leave it here
-    # until the moment when I figure out how to handle this case more professionally.
-    if "market_data" in df.columns:
-        df["market_data"] = df["market_data"].astype(str)
+    if not isinstance(json_data, dict):
+        logger.error("Unexpected JSON structure in %s: expected an object, got %s",
+                     path_to_json_file, type(json_data).__name__)
+        return None
 
-    processed_data_dir = os.getenv("PROCESSED_DATA_DIR")
-    particular_date_dir_processed_path = get_date_path_directories(
-        base_path=processed_data_dir,
-        year=file_date.year,
-        month=file_date.month,
-        day=file_date.day)
-    os.makedirs(particular_date_dir_processed_path, exist_ok=True)
-    path_to_parquet_file = os.path.join(particular_date_dir_processed_path, "file.parquet")
+    path_to_parquet_file = get_parquet_file_path(file_date)
+    os.makedirs(os.path.dirname(path_to_parquet_file), exist_ok=True)
+    # The existing Parquet file may be a hard link shared with other dates,
+    # so it is replaced by a new file instead of being overwritten in place.
+    path_to_part_file = get_part_file_path(path_to_parquet_file)
 
     try:
-        table = pa.Table.from_pandas(df)
-        pq.write_table(table, path_to_parquet_file)
+        table = build_table(json_data)
+        try:
+            pq.write_table(
+                table,
+                path_to_part_file,
+                compression=parquet_configs.compression,
+                compression_level=parquet_configs.compression_level,
+                use_dictionary=True,
+                data_page_size=parquet_configs.data_page_size,
+                write_statistics=True
+            )
+            os.replace(path_to_part_file, path_to_parquet_file)
+        except BaseException:
+            if os.path.exists(path_to_part_file):
+                os.unlink(path_to_part_file)
+            raise
         logger.info("Converted JSON to Parquet for date %s and saved to %s",
                      file_date, path_to_parquet_file)
     except pa.ArrowInvalid as e:
         logger.exception("Error writing Parquet file for date %s: %s",
                           file_date, e)
-        return
+        return None
+
+    return path_to_parquet_file
@@ -1,6 +1,9 @@
 import os
+import shutil
+from functools import lru_cache
 
 
+@lru_cache(maxsize=4096)
 def get_date_path_directories(base_path: str, year: int, month: int, day: int) -> str:
     """Constructs a directory path using the provided base path and date components.
 
@@ -16,3 +19,54 @@ def get_date_path_directories(base_path: str, year: int, month: int, day: int) -
 
     """
     return os.path.join(base_path, f"year={year}", f"month={month}", f"day={day}")
+
+
+def get_part_file_path(path_to_file: str) -> str:
+    """Constructs the path of the temporary file to write before moving it to the given path.
+
+    The name starts with a dot, so that readers of the partitioned directories
+    (e.g. pyarrow datasets or Spark) skip the file while it is being written.
+
+    Args:
+        path_to_file: The final file path.
+
+    Returns:
+        The path in the `{dir}/.{name}.part` format.
+
+    """
+    directory, file_name = os.path.split(path_to_file)
+    return os.path.join(directory, f".{file_name}.part")
+
+
+def link_file(path_to_source_file: str, path_to_target_file: str) -> None:
+    """Atomically makes the target path a hard link to the source file.
+
+    The link is created under a temporary hidden `.part` name and then moved into place,
+    replacing whatever the target path pointed to. If hard links are not supported
+    (e.g. across filesystems), the source file is copied instead. Nothing is done if
+    the target path is already a hard link to the source file.
+
+    Args:
+        path_to_source_file: The existing file to link to.
+        path_to_target_file: The path to make point to the source file.
+
+    """
+    # Renaming a file onto another link to the same inode is a no-op that would leave
+    # the temporary file behind, so this case is handled before creating it.
+    if os.path.exists(path_to_target_file) \
+            and os.path.samefile(path_to_source_file, path_to_target_file):
+        return
+    os.makedirs(os.path.dirname(path_to_target_file), exist_ok=True)
+    path_to_part_file = get_part_file_path(path_to_target_file)
+    try:
+        if os.path.lexists(path_to_part_file):
+            os.unlink(path_to_part_file)
+        try:
+            os.link(path_to_source_file, path_to_part_file)
+        except OSError:
+            shutil.copyfile(path_to_source_file, path_to_part_file)
+        os.replace(path_to_part_file, path_to_target_file)
+    except BaseException:
+        if os.path.lexists(path_to_part_file):
+            os.unlink(path_to_part_file)
+        raise